@@ -212,7 +212,7 @@ class Pokemon(BaseModel):
 
     @classmethod
     def get_spawnpoints_in_hex(cls, center, steps):
-        log.info('got {}steps'.format(steps))
+        log.info('got %dsteps', steps)
         # work out hex bounding box
         hdist = ((steps * 120.0) - 50.0) / 1000.0
         vdist = ((steps * 105.0) - 35.0) / 1000.0
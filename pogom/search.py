@@ -12,23 +12,35 @@ Search Architecture:
    - Starts search_worker threads
  - Search Worker Threads each:
    - Have a unique API login
-   - Listens to the same Queue for areas to scan
+   - Takes areas to scan from its own deque of the shared StealingQueue,
+     and steals from the other workers' deques once its own is empty
    - Can re-login as needed
-   - Shares a global lock for map parsing
+   - Parse maps concurrently; db and webhook writes go through queues
 '''
 
+import bisect
+import heapq
+import itertools
 import logging
 import math
 import json
 import os
 import random
+import sys
 import time
-import geopy
-import geopy.distance
 
 from operator import itemgetter
-from threading import Thread, Lock
-from queue import Queue, Empty
+from threading import Thread, Event, Condition, Lock
+from collections import deque
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+# Clock for delays and cooldowns that shouldn't follow wall clock changes.
+# Python 2 has none built in, the monotonic package provides it there.
+try:
+    from time import monotonic
+except ImportError:
+    from monotonic import monotonic
 
 from pgoapi import PGoApi
 from pgoapi.utilities import f2i
@@ -36,6 +48,7 @@ from pgoapi import utilities as util
 from pgoapi.exceptions import AuthException
 
 from .models import parse_map, Pokemon
+from .utils import memoize
 from .fakePogoApi import FakePogoApi
 import terminalsize
 
@@ -43,13 +56,31 @@ log = logging.getLogger(__name__)
 
 TIMESTAMP = '\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000'
 
+# Seconds an account sits out after failing too many scans in a row
+ACCOUNT_COOLDOWN = 2 * 60 * 60
+
+# S2 cell ids around each recently scanned location, see get_cell_ids()
+CELL_ID_CACHE_SIZE = 4096
+cell_id_cache = {}
+
+# Shared all-zero since_timestamp_ms lists, by number of cells. Never mutated.
+zero_timestamps = {}
+
+# Per account (by username) search state, e.g. when a tripped account is
+# allowed back in rotation ('open_until')
+account_state = {}
+
+# km radius of the earth, used by all the distance and coordinate math here
+EARTH_RADIUS = 6378.1
+
+
 
 def get_new_coords(init_loc, distance, bearing):
     """
     Given an initial lat/lng, a distance(in kms), and a bearing (degrees),
     this will calculate the resulting lat/lng coordinates.
     """
-    R = 6378.1  # km radius of the earth
+    R = EARTH_RADIUS
     bearing = math.radians(bearing)
 
     init_coords = [math.radians(init_loc[0]), math.radians(init_loc[1])]  # convert lat/lng to radians
@@ -65,59 +96,108 @@ def get_new_coords(init_loc, distance, bearing):
     return [math.degrees(new_lat), math.degrees(new_lon)]
 
 
-def generate_location_steps(initial_loc, step_count, step_distance):
-    # Bearing (degrees)
-    NORTH = 0
-    EAST = 90
-    SOUTH = 180
-    WEST = 270
+def haversine(loc1, loc2):
+    """
+    Returns the great circle distance in meters between two lat/lng points.
+    """
+    lat1, lat2 = math.radians(loc1[0]), math.radians(loc2[0])
+    return haversine_radians(lat1, math.radians(loc1[1]), math.cos(lat1),
+                             lat2, math.radians(loc2[1]), math.cos(lat2))
 
+
+def haversine_radians(lat1, lng1, cos_lat1, lat2, lng2, cos_lat2):
+    """
+    Same as haversine, but takes the coordinates in radians along with the
+    cosine of their latitude, for callers that can precompute them.
+    """
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         cos_lat1 * cos_lat2 * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * 1000 * math.asin(math.sqrt(a))
+
+
+def locations_near_spawnpoints(locations, spawnpoints, radius=70):
+    """
+    Returns the locations that have at least one spawnpoint within radius
+    meters of them.
+    """
+    if not spawnpoints:
+        return []
+
+    # Bucket the spawnpoints into cells at least radius wide, so only the
+    # spawnpoints in the 9 cells around a location need their distance checked
+    max_lat = max(abs(p[0]) for p in list(spawnpoints) + list(locations))
+    lat_size = math.degrees(radius / (EARTH_RADIUS * 1000))
+    lng_size = lat_size / math.cos(math.radians(min(max_lat, 89)))
+
+    cells = {}
+    for p in spawnpoints:
+        cells.setdefault((int(p[0] // lat_size), int(p[1] // lng_size)), []).append(p)
+
+    def any_spawnpoints_in_range(coords):
+        row, col = int(coords[0] // lat_size), int(coords[1] // lng_size)
+        for r in (row - 1, row, row + 1):
+            for c in (col - 1, col, col + 1):
+                for p in cells.get((r, c), ()):
+                    if haversine(coords, p) <= radius:
+                        return True
+        return False
+
+    return [coords for coords in locations if any_spawnpoints_in_range(coords)]
+
+
+# (rows north, columns east) moved along each edge of a hex ring, starting
+# from its top left corner: RIGHT, DOWN + RIGHT, DOWN + LEFT, LEFT, UP + LEFT
+# and UP + RIGHT
+HEX_RING_EDGES = ((0, 1), (-1, 0.5), (-1, -0.5), (0, -1), (1, -0.5), (1, 0.5))
+
+
+@memoize
+def _hex_offsets(step_count, step_distance):
+    """
+    Returns the (north, east) offsets in km from the center of every hex in
+    the grid, in the order the rings are walked. The grid is the same
+    wherever it is centered, so this is only worked out once per size.
+    """
     pulse_radius = step_distance            # km - radius of players heartbeat is 70m
     xdist = math.sqrt(3) * pulse_radius   # dist between column centers
     ydist = 3 * (pulse_radius / 2)          # dist between row centers
 
-    yield (initial_loc[0], initial_loc[1], 0)  # insert initial location
-
-    ring = 1
-    loc = initial_loc
-    while ring < step_count:
-        # Set loc to start at top left
-        loc = get_new_coords(loc, ydist, NORTH)
-        loc = get_new_coords(loc, xdist / 2, WEST)
-        for direction in range(6):
+    offsets = [(0.0, 0.0)]
+    for ring in range(1, step_count):
+        # Start at top left
+        row, col = float(ring), -ring / 2.0
+        for d_row, d_col in HEX_RING_EDGES:
             for i in range(ring):
-                if direction == 0:  # RIGHT
-                    loc = get_new_coords(loc, xdist, EAST)
-                if direction == 1:  # DOWN + RIGHT
-                    loc = get_new_coords(loc, ydist, SOUTH)
-                    loc = get_new_coords(loc, xdist / 2, EAST)
-                if direction == 2:  # DOWN + LEFT
-                    loc = get_new_coords(loc, ydist, SOUTH)
-                    loc = get_new_coords(loc, xdist / 2, WEST)
-                if direction == 3:  # LEFT
-                    loc = get_new_coords(loc, xdist, WEST)
-                if direction == 4:  # UP + LEFT
-                    loc = get_new_coords(loc, ydist, NORTH)
-                    loc = get_new_coords(loc, xdist / 2, WEST)
-                if direction == 5:  # UP + RIGHT
-                    loc = get_new_coords(loc, ydist, NORTH)
-                    loc = get_new_coords(loc, xdist / 2, EAST)
-                yield (loc[0], loc[1], 0)
-        ring += 1
+                row += d_row
+                col += d_col
+                offsets.append((row * ydist, col * xdist))
+    return tuple(offsets)
+
+
+def generate_location_steps(initial_loc, step_count, step_distance):
+    # The grid is only a few km wide, so the offsets can be projected onto
+    # the map as if the earth were flat around the initial location
+    lat_scale = math.degrees(1 / EARTH_RADIUS)
+    lng_scale = lat_scale / math.cos(math.radians(initial_loc[0]))
+
+    for north, east in _hex_offsets(step_count, step_distance):
+        yield (initial_loc[0] + north * lat_scale, initial_loc[1] + east * lng_scale, 0)
 
 
 # Apply a location jitter
 def jitterLocation(location=None, maxMeters=10):
-    origin = geopy.Point(location[0], location[1])
-    b = random.randint(0, 360)
-    d = math.sqrt(random.random()) * (float(maxMeters) / 1000)
-    destination = geopy.distance.distance(kilometers=d).destination(origin, b)
-    return (destination.latitude, destination.longitude, location[2])
+    # A few meters is small enough to treat the earth as flat
+    b = random.random() * 2 * math.pi
+    d = math.sqrt(random.random()) * (float(maxMeters) / 1000) / EARTH_RADIUS
+    lat = location[0] + math.degrees(d * math.cos(b))
+    lng = location[1] + math.degrees(d * math.sin(b) / math.cos(math.radians(location[0])))
+    return (lat, lng, location[2])
 
 
 # gets the current time past the hour
 def curSec():
-    return (60 * time.gmtime().tm_min) + time.gmtime().tm_sec
+    # The epoch starts on the hour, and has no leap seconds
+    return int(time.time()) % 3600
 
 
 # gets the diference between two times past the hour (in a range from -1800 to 1800)
@@ -130,24 +210,137 @@ def timeDif(a, b):
     return dif
 
 
-# binary search to get the lowest index of the item in Slist that has atleast time T
-def SbSearch(Slist, T):
-    first = 0
-    last = len(Slist) - 1
-    while first < last:
-        mp = (first + last) // 2
-        if Slist[mp]['time'] < T:
-            first = mp + 1
-        else:
-            last = mp
-    return first
+# Removes everything from a Queue in one go and returns the removed items
+def drain_queue(q):
+    with q.mutex:
+        items = q.queue
+        q.queue = deque()
+        # Count the removed items as done, as get() + task_done() would have
+        q.unfinished_tasks -= len(items)
+        if q.unfinished_tasks <= 0:
+            q.all_tasks_done.notify_all()
+        q.not_full.notify_all()
+    return items
+
+
+class StealingQueue(object):
+    '''
+    Work queue for the hex search workers, split into one deque per worker.
+    Each worker takes items from its own deque and steals from the others
+    once it runs dry, so they don't all contend for a single lock.
+    '''
+
+    def __init__(self, workers):
+        self.deques = [deque() for i in range(workers)]
+        # Set whenever items are added, to wake up idle workers
+        self.events = [Event() for i in range(workers)]
+        self.next_deque = itertools.count()
+        # Counts the search locations, items carry the one they belong to
+        # as their last field (see put_back)
+        self.generation = 0
+        self.lock = Lock()
+
+    def put(self, item):
+        self.deques[next(self.next_deque) % len(self.deques)].append(item)
+        self.notify()
+
+    # Deals the items out round robin, so the workers still start on the
+    # first items together
+    def put_many(self, items):
+        for i, d in enumerate(self.deques):
+            d.extend(items[i::len(self.deques)])
+        self.notify()
+
+    # Blocks until there is an item for the given worker
+    def get(self, worker):
+        while True:
+            # Clear first, so items added while looking still wake us up
+            self.events[worker].clear()
+            for i in range(len(self.deques)):
+                try:
+                    return self.deques[(worker + i) % len(self.deques)].popleft()
+                except IndexError:
+                    pass
+            self.events[worker].wait()
+
+    def notify(self):
+        for event in self.events:
+            event.set()
+
+    # With new_location, the items still held by workers become stale too
+    def clear(self, new_location=False):
+        with self.lock:
+            if new_location:
+                self.generation += 1
+            for d in self.deques:
+                d.clear()
+
+    # Puts back an item a worker failed to scan, unless the overseer moved
+    # on to a new location since. Returns whether it was put back.
+    def put_back(self, item):
+        with self.lock:
+            if item[-1] != self.generation:
+                return False
+            self.put(item)
+            return True
+
+    def qsize(self):
+        return sum(len(d) for d in self.deques)
+
+    def empty(self):
+        return not any(self.deques)
+
+
+class SpawnQueue(object):
+    '''
+    Queue of spawnpoints for a spawnpoint scan worker, earliest spawn first.
+    Spawnpoints we are 14mins (or more) too late for are dropped rather
+    than handed out, and counted in skipped.
+    '''
+
+    def __init__(self):
+        self.heap = []
+        self.cond = Condition()
+        self.seq = itertools.count()  # keeps equal spawn times in order
+        self.skipped = 0
+
+    def put(self, item):
+        spawntime = item[3]
+        # Spawn times are seconds past the hour, key the heap on the actual
+        # time so the order doesn't break when the hour wraps around
+        now = time.time()
+        due = now + timeDif(spawntime, curSec())
+        with self.cond:
+            self.drop_stale(now)
+            heapq.heappush(self.heap, (due, next(self.seq), item))
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while True:
+                self.drop_stale(time.time())
+                if self.heap:
+                    return heapq.heappop(self.heap)[2]
+                self.cond.wait()
+
+    # Must be called holding cond
+    def drop_stale(self, now):
+        while self.heap and now - self.heap[0][0] >= 840:
+            heapq.heappop(self.heap)
+            self.skipped += 1
+
+    def qsize(self):
+        return len(self.heap)
 
 
 # Thread to handle user input
-def switch_status_printer(display_enabled, current_page):
+def switch_status_printer(display_enabled, current_page, command_result):
     while True:
         # Wait for the user to press a key
         command = raw_input()
+        # Logging is off on the status screen, so command results are shown
+        # there instead, until the next command
+        command_result[0] = None
 
         if command == '':
             # Switch between logging and display.
@@ -159,18 +352,48 @@ def switch_status_printer(display_enabled, current_page):
                 display_enabled[0] = True
         elif command.isdigit():
                 current_page[0] = int(command)
+        elif command.startswith('unban '):
+            # Put an account that failed too often back to work
+            username = command[len('unban '):].strip()
+            if unban_account(username):
+                command_result[0] = 'Account {} will be back in rotation within 5 seconds'.format(username)
+            else:
+                command_result[0] = 'Account {} is not out of rotation'.format(username)
+
+
+# Returns True if the terminal understands ANSI escape codes
+def enable_ansi_escapes():
+    if os.name != 'nt':
+        return True
+
+    # Windows 10 consoles handle them once virtual terminal processing is
+    # switched on, older ones don't at all
+    try:
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+        mode = ctypes.c_ulong()
+        if not kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+            return False
+        return bool(kernel32.SetConsoleMode(handle, mode.value | 0x0004))  # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+    except Exception:
+        return False
 
 
 # Thread to print out the status of each worker
 def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue):
     display_enabled = [True]
     current_page = [1]
+    command_result = [None]
     logging.disable(logging.ERROR)
+    ansi_escapes = enable_ansi_escapes()
+    worker_lines = {}
+    worker_order = []
 
     # Start another thread to get user input
     t = Thread(target=switch_status_printer,
                name='switch_status_printer',
-               args=(display_enabled, current_page))
+               args=(display_enabled, current_page, command_result))
     t.daemon = True
     t.start()
 
@@ -181,6 +404,10 @@ def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue)
             width, height = terminalsize.get_terminal_size()
             # Queue and overseer take 2 lines.  Switch message takes up 2 lines.  Remove an extra 2 for things like screen status lines.
             usable_height = height - 6
+            # And one more for the result of the last command, if any
+            result = command_result[0]
+            if result:
+                usable_height -= 1
             # Prevent people running terminals only 6 lines high from getting a divide by zero
             if usable_height < 1:
                 usable_height = 1
@@ -197,9 +424,16 @@ def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue)
 
             # Print status of overseer
             status_text.append('{} Overseer: {}'.format(threadStatus['Overseer']['method'], threadStatus['Overseer']['message']))
+            if result:
+                status_text.append(result)
 
-            # Calculate the total number of pages.  Subtracting 1 for the overseer.
-            total_pages = math.ceil((len(threadStatus) - 1) / float(usable_height))
+            # The workers are only added once, at startup, so the sorted
+            # order only needs redoing while they are being created
+            if len(worker_order) != len(threadStatus) - 1:
+                worker_order = sorted(k for k in threadStatus.keys() if threadStatus[k]['type'] == "Worker")
+
+            # Calculate the total number of pages.
+            total_pages = math.ceil(len(worker_order) / float(usable_height))
 
             # Prevent moving outside the valid range of pages
             if current_page[0] > total_pages:
@@ -213,25 +447,33 @@ def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue)
             current_line = 1
 
             # Print the worker status
-            for item in sorted(threadStatus):
-                if(threadStatus[item]['type'] == "Worker"):
-                    current_line += 1
-
-                    # Skip over items that don't belong on this page
-                    if current_line < start_line:
-                        continue
-                    if current_line > end_line:
-                        break
-
-                    if 'skip' in threadStatus[item]:
-                        status_text.append('{} - Success: {}, Failed: {}, No Items: {}, Skipped: {} - {}'.format(item, threadStatus[item]['success'], threadStatus[item]['fail'], threadStatus[item]['noitems'], threadStatus[item]['skip'], threadStatus[item]['message']))
+            for item in worker_order:
+                current_line += 1
+
+                # Skip over items that don't belong on this page
+                if current_line < start_line:
+                    continue
+                if current_line > end_line:
+                    break
+
+                # Only rebuild the line when the worker status changed
+                worker = threadStatus[item]
+                key = worker['seq']
+                if item not in worker_lines or worker_lines[item][0] != key:
+                    if 'skip' in worker:
+                        line = '{} - Success: {}, Failed: {}, No Items: {}, Skipped: {} - {}'.format(item, worker['success'], worker['fail'], worker['noitems'], worker['skip'], worker['message'])
                     else:
-                        status_text.append('{} - Success: {}, Failed: {}, No Items: {} - {}'.format(item, threadStatus[item]['success'], threadStatus[item]['fail'], threadStatus[item]['noitems'], threadStatus[item]['message']))
-            status_text.append('Page {}/{}.  Type page number and <ENTER> to switch pages.  Press <ENTER> alone to switch between status and log view'.format(current_page[0], total_pages))
-            # Clear the screen
-            os.system('cls' if os.name == 'nt' else 'clear')
-            # Print status
-            print "\n".join(status_text)
+                        line = '{} - Success: {}, Failed: {}, No Items: {} - {}'.format(item, worker['success'], worker['fail'], worker['noitems'], worker['message'])
+                    worker_lines[item] = (key, line)
+                status_text.append(worker_lines[item][1])
+            status_text.append('Page {}/{}.  Type page number and <ENTER> to switch pages.  Press <ENTER> alone to switch between status and log view.  Type unban <username> to put a failed account back to work'.format(current_page[0], total_pages))
+            # Clear the screen and print the status in a single write
+            if ansi_escapes:
+                sys.stdout.write('\033[2J\033[H' + '\n'.join(status_text) + '\n')
+            else:
+                os.system('cls')
+                sys.stdout.write('\n'.join(status_text) + '\n')
+            sys.stdout.flush()
         time.sleep(1)
 
 
@@ -240,8 +482,7 @@ def search_overseer_thread(args, new_location_queue, pause_bit, encryption_lib_p
 
     log.info('Search overseer starting')
 
-    search_items_queue = Queue()
-    parse_lock = Lock()
+    search_items_queue = StealingQueue(len(args.accounts))
     threadStatus = {}
 
     threadStatus['Overseer'] = {}
@@ -267,10 +508,11 @@ def search_overseer_thread(args, new_location_queue, pause_bit, encryption_lib_p
         threadStatus['Worker {:03}'.format(i)]['success'] = 0
         threadStatus['Worker {:03}'.format(i)]['fail'] = 0
         threadStatus['Worker {:03}'.format(i)]['noitems'] = 0
+        threadStatus['Worker {:03}'.format(i)]['seq'] = 0
 
         t = Thread(target=search_worker_thread,
                    name='search-worker-{}'.format(i),
-                   args=(args, account, search_items_queue, parse_lock,
+                   args=(args, account, i, search_items_queue,
                          encryption_lib_path, threadStatus['Worker {:03}'.format(i)],
                          db_updates_queue, wh_queue))
         t.daemon = True
@@ -279,6 +521,7 @@ def search_overseer_thread(args, new_location_queue, pause_bit, encryption_lib_p
     # A place to track the current location
     current_location = False
     locations = []
+    search_items = []
     spawnpoints = set()
 
     # The real work starts here but will halt on pause_bit.set()
@@ -286,12 +529,7 @@ def search_overseer_thread(args, new_location_queue, pause_bit, encryption_lib_p
 
         # paused; clear queue if needed, otherwise sleep and loop
         if pause_bit.is_set():
-            if not search_items_queue.empty():
-                try:
-                    while True:
-                        search_items_queue.get_nowait()
-                except Empty:
-                    pass
+            search_items_queue.clear()
             threadStatus['Overseer']['message'] = "Scanning is paused"
             time.sleep(1)
             continue
@@ -299,19 +537,10 @@ def search_overseer_thread(args, new_location_queue, pause_bit, encryption_lib_p
         # If a new location has been passed to us, get the most recent one
         if not new_location_queue.empty():
             log.info('New location caught, moving search grid')
-            try:
-                while True:
-                    current_location = new_location_queue.get_nowait()
-            except Empty:
-                pass
+            current_location = drain_queue(new_location_queue)[-1]
 
             # We (may) need to clear the search_items_queue
-            if not search_items_queue.empty():
-                try:
-                    while True:
-                        search_items_queue.get_nowait()
-                except Empty:
-                    pass
+            search_items_queue.clear(new_location=True)
 
             # if we are only scanning for pokestops/gyms, then increase step radius to visibility range
             if args.no_pokemon:
@@ -338,23 +567,23 @@ def search_overseer_thread(args, new_location_queue, pause_bit, encryption_lib_p
                 if len(spawnpoints) == 0:
                     log.warning('No spawnpoints found in the specified area! (Did you forget to run a normal scan in this area first?)')
 
-                def any_spawnpoints_in_range(coords):
-                    return any(geopy.distance.distance(coords, x).meters <= 70 for x in spawnpoints)
-
-                locations = [coords for coords in locations if any_spawnpoints_in_range(coords)]
+                locations = locations_near_spawnpoints(locations, spawnpoints)
 
             if len(locations) == 0:
                 log.warning('Nothing to scan!')
 
+            # The queue items for one pass over the locations. The requeued
+            # field tells whether a step was already put back after failing.
+            search_items = [(step, loc, f2i_location(loc), False, search_items_queue.generation)
+                            for step, loc in enumerate(locations, 1)]
+
         # If there are no search_items_queue either the loop has finished (or been
         # cleared above) -- either way, time to fill it back up
         if search_items_queue.empty():
             log.debug('Search queue empty, restarting loop')
-            for step, step_location in enumerate(locations, 1):
-                log.debug('Queueing step %d @ %f/%f/%f', step, step_location[0], step_location[1], step_location[2])
-                threadStatus['Overseer']['message'] = "Queuing next step"
-                search_args = (step, step_location)
-                search_items_queue.put(search_args)
+            threadStatus['Overseer']['message'] = "Queuing next step"
+            log.debug('Queueing %d steps', len(locations))
+            search_items_queue.put_many(search_items)
         else:
             #   log.info('Search queue processing, %d items left', search_items_queue.qsize())
             threadStatus['Overseer']['message'] = "Processing search queue"
@@ -366,7 +595,6 @@ def search_overseer_thread(args, new_location_queue, pause_bit, encryption_lib_p
 def search_overseer_thread_ss(args, new_location_queue, pause_bit, encryption_lib_path, db_updates_queue, wh_queue):
     log.info('Search ss overseer starting')
     search_items_queues = []
-    parse_lock = Lock()
     spawns = []
     threadStatus = {}
 
@@ -387,7 +615,7 @@ def search_overseer_thread_ss(args, new_location_queue, pause_bit, encryption_li
     log.info('Starting search worker threads')
     for i, account in enumerate(args.accounts):
         log.debug('Starting search worker thread %d for user %s', i, account['username'])
-        search_items_queues.append(Queue())
+        search_items_queues.append(SpawnQueue())
         threadStatus['Worker {:03}'.format(i)] = {}
         threadStatus['Worker {:03}'.format(i)]['type'] = "Worker"
         threadStatus['Worker {:03}'.format(i)]['message'] = "Creating thread..."
@@ -395,9 +623,10 @@ def search_overseer_thread_ss(args, new_location_queue, pause_bit, encryption_li
         threadStatus['Worker {:03}'.format(i)]['fail'] = 0
         threadStatus['Worker {:03}'.format(i)]['skip'] = 0
         threadStatus['Worker {:03}'.format(i)]['noitems'] = 0
+        threadStatus['Worker {:03}'.format(i)]['seq'] = 0
         t = Thread(target=search_worker_thread_ss,
                    name='ss-worker-{}'.format(i),
-                   args=(args, account, search_items_queues[i], parse_lock,
+                   args=(args, account, i, search_items_queues[i],
                          encryption_lib_path, threadStatus['Worker {:03}'.format(i)],
                          db_updates_queue, wh_queue))
         t.daemon = True
@@ -410,11 +639,11 @@ def search_overseer_thread_ss(args, new_location_queue, pause_bit, encryption_li
                 try:
                     spawns = json.load(file)
                 except ValueError:
-                    log.error(args.spawnpoint_scanning + " is not valid")
+                    log.error('%s is not valid', args.spawnpoint_scanning)
                     return
                 file.close()
         except IOError:
-            log.error("Error opening " + args.spawnpoint_scanning)
+            log.error('Error opening %s', args.spawnpoint_scanning)
             return
     else:  # if spawns file dose not exist use the db
         threadStatus['Overseer']['message'] = "Getting spawnpoints from database"
@@ -422,30 +651,40 @@ def search_overseer_thread_ss(args, new_location_queue, pause_bit, encryption_li
         spawns = Pokemon.get_spawnpoints_in_hex(loc, args.step_limit)
     spawns = assign_spawns(spawns, len(args.accounts), args.scan_delay, args.max_speed, args.max_delay)
     log.info('Total of %d spawns to track', len(spawns))
+    for sp in spawns:
+        sp['loc_i'] = f2i_location((sp['lat'], sp['lng']))
     # find the inital location (spawn thats 60sec old)
-    pos = SbSearch(spawns, (curSec() + 3540) % 3600)
+    spawn_times = [sp['time'] for sp in spawns]
+    pos = bisect.bisect_left(spawn_times, (curSec() + 3540) % 3600) % len(spawns)
     while True:
         while timeDif(curSec(), spawns[pos]['time']) < 60:
-            threadStatus['Overseer']['message'] = "Waiting for spawnpoints {} of {} to spawn at {}".format(pos, len(spawns), spawns[pos]['time'])
+            threadStatus['Overseer']['message'] = LazyMessage("Waiting for spawnpoints {} of {} to spawn at {}", pos, len(spawns), spawns[pos]['time'])
             time.sleep(1)
         # make location with a dummy height (seems to be more reliable than 0 height)
-        threadStatus['Overseer']['message'] = "Queuing spawnpoint {} of {}".format(pos, len(spawns))
+        threadStatus['Overseer']['message'] = LazyMessage("Queuing spawnpoint {} of {}", pos, len(spawns))
         location = [spawns[pos]['lat'], spawns[pos]['lng'], 40.32]
-        search_args = (pos, location, spawns[pos]['time'])
+        search_args = (pos, location, spawns[pos]['loc_i'], spawns[pos]['time'])
         search_items_queues[spawns[pos]['worker']].put(search_args)
         pos = (pos + 1) % len(spawns)
 
 
 def assign_spawns(spawns, num_workers, scan_delay, max_speed, max_delay):
 
-    log.info('Attemping to assign %d spawn points to %d accounts' % (len(spawns), num_workers))
+    log.info('Attemping to assign %d spawn points to %d accounts', len(spawns), num_workers)
+
+    # Precompute what the haversine distance needs from each spawnpoint
+    for sp in spawns:
+        sp['lat_r'] = math.radians(sp['lat'])
+        sp['lng_r'] = math.radians(sp['lng'])
+        sp['cos_lat'] = math.cos(sp['lat_r'])
 
     def dist(sp1, sp2):
-        dist = geopy.distance.distance((sp1['lat'], sp1['lng']), (sp2['lat'], sp2['lng'])).meters
-        return dist
+        return haversine_radians(sp1['lat_r'], sp1['lng_r'], sp1['cos_lat'],
+                                 sp2['lat_r'], sp2['lng_r'], sp2['cos_lat'])
 
-    def speed(sp1, sp2):
-        time = max((sp2['time'] - sp1['time']) % 3600, scan_delay)
+    # Speed needed to get from sp1 at time t1 to sp2 at time t2
+    def speed(sp1, t1, sp2, t2):
+        time = max((t2 - t1) % 3600, scan_delay)
         if time == 0:
             return float('inf')
         else:
@@ -455,7 +694,7 @@ def assign_spawns(spawns, num_workers, scan_delay, max_speed, max_delay):
         s = []
         for i in range(len(q)):
             j = (i + 1) % len(q)
-            s.append(speed(q[i], q[j]))
+            s.append(speed(q[i], q[i]['time'], q[j], q[j]['time']))
         print 'Max speed: %f, avg speed %f' % (max(s), sum(s)/len(s))
 
     # Insert has has two modes of operation.
@@ -465,32 +704,39 @@ def assign_spawns(spawns, num_workers, scan_delay, max_speed, max_delay):
     # scan sp, s2 is the speed that the worker need to travel after scanning
     # sp, and s0 = max(s1, s2)
     # If dry=False, it will insert sp to the proper location
-    def insert(queue, sp, dry):
-        # make a copy so we don't change the spawnpoint passed in
-        sp = dict(sp)
-
+    # times holds the scan time of each point in queue, in the same order.
+    # unordered[0] counts the neighbouring points in times that are out of
+    # order, which a successful wiggle can cause.
+    def insert(queue, times, unordered, sp, dry):
         if len(queue) == 0:
             if not dry:
-                queue.append(sp)
+                # make a copy so we don't change the spawnpoint passed in
+                queue.append(dict(sp))
+                times.append(sp['time'])
             return 0, max_speed, max_speed, max_speed
 
-        # Find the slot to insert sp
-        l = [True if p['time'] <= sp['time'] else False for p in queue]
-        # k is the slot to call `insert' with at the end
-        k = l.index(False) if False in l else len(l)
+        # Find the slot to insert sp, k is the slot to call `insert' with at the end.
+        # It's the first point scanned after sp, which bisect only finds while
+        # times is in order.
+        if unordered[0]:
+            k = next((x for x, ts in enumerate(times) if ts > sp['time']), len(times))
+        else:
+            k = bisect.bisect_right(times, sp['time'])
         # i is the previous point index
         i = (k - 1) % len(queue)
         # j is the next point index
         j = k % len(queue)
+        prev, next_sp = queue[i], queue[j]
 
-        # Make scan time at least scan_delay after the previous point
-        sp['time'] = max(sp['time'], queue[i]['time'] + scan_delay)
+        # Make scan time at least scan_delay after the previous point. Only
+        # the time of sp is tracked here, so dry runs don't need to copy it.
+        t = max(sp['time'], prev['time'] + scan_delay)
 
         # Calculate scanner speeds incurred by adding sp
-        s1 = speed(queue[i], sp)
-        s2 = speed(sp, queue[j])
+        s1 = speed(prev, prev['time'], sp, t)
+        s2 = speed(sp, t, next_sp, next_sp['time'])
 
-        if i != j and (queue[j]['time'] - queue[i]['time']) % 3600 < 2 * scan_delay:
+        if i != j and (next_sp['time'] - prev['time']) % 3600 < 2 * scan_delay:
             # No room for sp
             score = (float('inf'), 0, 0, 0)
         elif s1 <= max_speed and s2 <= max_speed:
@@ -501,19 +747,29 @@ def assign_spawns(spawns, num_workers, scan_delay, max_speed, max_delay):
             score = (float('inf'), 0, 0, 0)
         else:
             # s1 > max_speed, try to wiggle the scan time for sp
-            time2wait = (dist(queue[i], sp) / max_speed) - (sp['time'] - queue[i]['time'])
-            if time2wait > (sp['time'] - queue[j]['time']) % 3600:
+            time2wait = (dist(prev, sp) / max_speed) - (t - prev['time'])
+            if time2wait > (t - next_sp['time']) % 3600:
                 # Wiggle failed
                 score = (float('inf'), 0, 0, 0)
             else:
                 # Wiggle successful, add time2wait as delay
-                sp['time'] += time2wait
+                t += time2wait
                 s1 = max_speed
-                s2 = speed(sp, queue[j])
+                s2 = speed(sp, t, next_sp, next_sp['time'])
                 score = (time2wait, max(s1, s2), s1, s2)
 
         if not dry and score[0] < float('inf'):
-            queue.insert(k, sp)
+            # sp goes between times[k - 1] and times[k], keep count of how
+            # that changes the order
+            if 0 < k < len(times) and times[k - 1] > times[k]:
+                unordered[0] -= 1
+            if k > 0 and times[k - 1] > t:
+                unordered[0] += 1
+            if k < len(times) and t > times[k]:
+                unordered[0] += 1
+            # make a copy so we don't change the spawnpoint passed in
+            queue.insert(k, dict(sp, time=t))
+            times.insert(k, t)
 
         return score
 
@@ -522,34 +778,36 @@ def assign_spawns(spawns, num_workers, scan_delay, max_speed, max_delay):
     def greedy_assign(spawns, n):
         spawns.sort(key=itemgetter('time'))
         Q = [[] for i in range(n)]
+        T = [[] for i in range(n)]
+        U = [[0] for i in range(n)]
         delays = []
         bad = []
         for sp in spawns:
-            scores = [(insert(q, sp, True), i) for i, q in enumerate(Q)]
+            scores = [(insert(q, T[i], U[i], sp, True), i) for i, q in enumerate(Q)]
             min_score, min_index = min(scores)
             delay, s0, s1, s2 = min_score
             if delay <= max_delay:
-                insert(Q[min_index], sp, False)
+                insert(Q[min_index], T[min_index], U[min_index], sp, False)
                 if delay > 0:
                     delays.append(delay)
             else:
                 bad.append(sp)
 
-        log.info("Assigned %d spawn points to %d workers, left out %d points" %
-                (len(spawns) - len(bad), n, len(bad)))
+        log.info("Assigned %d spawn points to %d workers, left out %d points",
+                 len(spawns) - len(bad), n, len(bad))
         return Q, delays, bad
 
     Q, delays, bad = greedy_assign(spawns, num_workers)
 
     if len(bad):
-        log.info('Cannot schedule %d spawnpoints under max_delay, dropping.' % len(bad))
+        log.info('Cannot schedule %d spawnpoints under max_delay, dropping.', len(bad))
 
     log.debug('Completed job assignment.')
-    log.info('Job queue sizes: %s' % str([len(q) for q in Q]))
+    log.info('Job queue sizes: %s', [len(q) for q in Q])
     if len(delays):
-        log.info('Number of scan delays: %d.' % len(delays))
-        log.info('Average delay: %f seconds.' % (sum(delays) / len(delays)))
-        log.info('Max delay: %f seconds.' % max(delays))
+        log.info('Number of scan delays: %d.', len(delays))
+        log.info('Average delay: %f seconds.', sum(delays) / len(delays))
+        log.info('Max delay: %f seconds.', max(delays))
         if max(delays) > 60:
             log.info('Cannot assign spawn points with delay less than a minute. You should try increasing number of accounts or decreasing number of spawn points.')
     else:
@@ -561,45 +819,159 @@ def assign_spawns(spawns, num_workers, scan_delay, max_speed, max_delay):
             sp['worker'] = index
 
     # Merge individual job queues back to one queue and sort it
-    spawns = sum(Q, [])
+    spawns = list(itertools.chain.from_iterable(Q))
     spawns.sort(key=itemgetter('time'))
 
     return spawns
 
 
-def search_worker_thread(args, account, search_items_queue, parse_lock, encryption_lib_path, status, dbq, whq):
+# Time to sleep after a scan failed failed_total (1 or more) times in a row.
+# Drawn at random between scan_delay and an exponentially growing ceiling, so
+# workers that failed together don't retry together and no retry goes out
+# sooner than scan_delay. The ceiling stops at scan_delay_max, but never below
+# twice scan_delay, so there is always some jitter.
+def retry_delay(args, failed_total):
+    cap = max(args.scan_delay_max, 2 * args.scan_delay)
+    return random.uniform(args.scan_delay, min(args.scan_delay * 2 ** min(failed_total, 5), cap))
+
+
+# Time to sleep after an unexpected error in a worker loop. The first one is
+# most likely a one-off and retried after a second, but errors that keep
+# coming back (say the encryption library won't load) back off like failed
+# scans do, instead of looping and logging once a second.
+def error_delay(args, errors_in_a_row):
+    if errors_in_a_row <= 1:
+        return 1
+    return retry_delay(args, errors_in_a_row - 1)
+
+
+# Delay between two scans of a worker. With --adaptive-delay it stretches
+# with the worker's recent failure rate, up to 11 times the configured delay
+# when every scan fails, and shrinks back once scans succeed again.
+def scan_delay(args, fail_rate):
+    if args.adaptive_delay:
+        return args.scan_delay * (1 + 10 * fail_rate)
+    return args.scan_delay
+
+
+# Exponential moving average of a worker's failed scans (failed is 1 or 0)
+def update_fail_rate(fail_rate, failed):
+    return 0.9 * fail_rate + 0.1 * failed
+
+
+# Takes an account out of rotation for ACCOUNT_COOLDOWN seconds after it
+# failed too many scans in a row, it's possibly banned
+def trip_account(account, status):
+    state = account_state.setdefault(account['username'], {})
+    state['open_until'] = monotonic() + ACCOUNT_COOLDOWN
+    wake_time = time.strftime('%H:%M', time.localtime(time.time() + ACCOUNT_COOLDOWN))
+    log.error('Worker %s failed, possibly banned account. Sleeping until %s', account['username'], wake_time)
+    update_status(status, message=LazyMessage('Worker {} failed, possibly banned account. Sleeping until {}', account['username'], wake_time))
+
+
+# Sleeps until the account is back in rotation. Returns True if it had to wait.
+# Sleeps in short chunks so that unban_account() takes effect within seconds.
+def wait_for_account(account):
+    state = account_state.get(account['username'], {})
+    remaining = state.get('open_until', 0) - monotonic()
+    if remaining <= 0:
+        return False
+    while remaining > 0:
+        time.sleep(min(remaining, 5))
+        remaining = state['open_until'] - monotonic()
+    log.info('Account %s is back in rotation', account['username'])
+    return True
+
+
+# Puts a tripped account back in rotation before its cooldown is over.
+# Returns False if the account wasn't out of rotation.
+def unban_account(username):
+    state = account_state.get(username)
+    if state is None or state['open_until'] <= monotonic():
+        return False
+    state['open_until'] = 0
+    return True
+
+
+# Connection pool shared by the sessions of all worker APIs, so keep-alive
+# connections survive account restarts instead of redoing the TLS handshake.
+# Only the adapter is shared: each API keeps its own session and cookies.
+http_adapter = None
+http_adapter_lock = Lock()
+
+
+def get_http_adapter(args):
+    global http_adapter
+
+    with http_adapter_lock:
+        if http_adapter is None:
+            pool_size = max(len(args.accounts), 1)
+            http_adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size * 2)
+
+    return http_adapter
 
-    stagger_thread(args, account)
+
+# Create an API instance for a search worker
+def new_api(args, encryption_lib_path):
+    if args.mock != '':
+        api = FakePogoApi(args.mock)
+    else:
+        api = PGoApi()
+        session = getattr(api, '_session', None)
+        if session is not None:
+            adapter = get_http_adapter(args)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+    if args.proxy:
+        api.set_proxy({'http': args.proxy, 'https': args.proxy})
+
+    api.activate_signature(encryption_lib_path)
+    return api
+
+
+def search_worker_thread(args, account, account_index, search_items_queue, encryption_lib_path, status, dbq, whq):
+
+    stagger_thread(args, account_index)
 
     log.debug('Search worker thread starting')
 
+    # Time to back off after an error, until a scan sets it
+    sleep_time = args.scan_delay
+
+    # Unexpected errors since the last successful scan, see error_delay()
+    errors_in_a_row = 0
+
+    # The API instance this will use, kept across retries of the loop
+    api = None
+
+    # Moving average of how many of our scans failed, see scan_delay()
+    fail_rate = 0.0
+
     # The forever loop for the thread
     while True:
         try:
             log.debug('Entering search loop')
-            status['message'] = "Entering search loop"
-
-            # Create the API instance this will use
-            if args.mock != '':
-                api = FakePogoApi(args.mock)
-            else:
-                api = PGoApi()
-
-            if args.proxy:
-                api.set_proxy({'http': args.proxy, 'https': args.proxy})
 
-            api.activate_signature(encryption_lib_path)
+            if api is None:
+                api = new_api(args, encryption_lib_path)
+                next_relogin_at = 0
 
             # Get current time
-            loop_start_time = int(round(time.time() * 1000))
+            loop_start_time = monotonic()
 
             # The forever loop for the searches
             while True:
 
+                # Sit out the cooldown if the account failed too often,
+                # without bursting through the missed scan delays after
+                if wait_for_account(account):
+                    loop_start_time = monotonic()
+
                 # Grab the next thing to search (when available)
-                status['message'] = "Waiting for item from queue"
-                step, step_location = search_items_queue.get()
-                status['message'] = "Searching at {},{}".format(step_location[0], step_location[1])
+                update_status(status, message="Waiting for item from queue")
+                step, step_location, step_location_i, requeued, generation = search_items_queue.get(account_index)
+                update_status(status, message=LazyMessage("Searching at {},{}", step_location[0], step_location[1]))
                 log.info('Search step %d beginning (queue size is %d)', step, search_items_queue.qsize())
 
                 # Let the api know where we intend to be for this loop
@@ -611,43 +983,23 @@ def search_worker_thread(args, account, search_items_queue, parse_lock, encrypti
 
                     # After so many attempts, let's get out of here
                     if failed_total >= args.scan_retries:
-                        # I am choosing to NOT place this item back in the queue
-                        # otherwise we could get a "bad scan" area and be stuck
-                        # on this overall loop forever. Better to lose one cell
-                        # than have the scanner, essentially, halt.
-                        log.error('Search step %d went over max scan_retires; abandoning', step)
-                        status['message'] = "Search step went over max scan_retries; abandoning"
-
-                        # Didn't succeed, but we are done with this queue item
-                        search_items_queue.task_done()
-
-                        # Sleep for 2 hours, print a log message every 5 minutes.
-                        long_sleep_time = 0
-                        long_sleep_started = time.strftime("%H:%M")
-                        while long_sleep_time < (2 * 60 * 20):
-                            log.error('Worker %s failed, possibly banned account. Started 2 hour sleep at %s', account['username'], long_sleep_started)
-                            status['message'] = 'Worker {} failed, possibly banned account. Started 2 hour sleep at {}'.format(account['username'], long_sleep_started)
-                            long_sleep_time += 300
-                            time.sleep(300)
                         break
 
-                    # Increase sleep delay between each failed scan
-                    # By default scan_dela=5, scan_retries=5 so
-                    # We'd see timeouts of 5, 10, 15, 20, 25
-                    sleep_time = args.scan_delay * (1 + failed_total)
-
-                    # Ok, let's get started -- check our login status
-                    check_login(args, account, api, step_location)
+                    # Ok, let's get started -- check our login status once
+                    # the credentials are about to expire
+                    if time.time() >= next_relogin_at:
+                        next_relogin_at = check_login(args, account, api)
 
                     # Make the actual request (finally!)
-                    response_dict = map_request(api, step_location, args.jitter)
+                    response_dict = map_request(api, step_location, args.jitter, step_location_i)
 
                     # G'damnit, nothing back. Mark it up, sleep, carry on
                     if not response_dict:
-                        log.error('Search step %d area download failed, retrying request in %g seconds', step, sleep_time)
                         failed_total += 1
-                        status['fail'] += 1
-                        status['message'] = "Failed {} times to scan {},{} - no response - sleeping {} seconds. Username: {}".format(failed_total, step_location[0], step_location[1], sleep_time, account['username'])
+                        sleep_time = retry_delay(args, failed_total)
+                        log.error('Search step %d area download failed, retrying request in %g seconds', step, sleep_time)
+                        update_status(status, fail=status['fail'] + 1, message=LazyMessage("Failed {} times to scan {},{} - no response - sleeping {} seconds. Username: {}", failed_total, step_location[0], step_location[1], sleep_time, account['username']))
+                        fail_rate = update_fail_rate(fail_rate, 1)
                         time.sleep(sleep_time)
                         continue
 
@@ -655,133 +1007,180 @@ def search_worker_thread(args, account, search_items_queue, parse_lock, encrypti
                     try:
                         findCount = parse_map(args, response_dict, step_location, dbq, whq)
                         log.debug('Search step %s completed', step)
-                        search_items_queue.task_done()
                         if findCount > 0:
-                            status['success'] += 1
+                            update_status(status, success=status['success'] + 1)
                         else:
-                            status['noitems'] += 1
+                            update_status(status, noitems=status['noitems'] + 1)
+                        fail_rate = update_fail_rate(fail_rate, 0)
+                        errors_in_a_row = 0
                         break  # All done, get out of the request-retry loop
                     except KeyError:
-                        log.exception('Search step %s map parsing failed, retrying request in %g seconds. Username: %s', step, sleep_time, account['username'])
                         failed_total += 1
-                        status['fail'] += 1
-                        status['message'] = "Failed {} times to scan {},{} - map parsing failed - sleeping {} seconds. Username: {}".format(failed_total, step_location[0], step_location[1], sleep_time, account['username'])
+                        sleep_time = retry_delay(args, failed_total)
+                        log.exception('Search step %s map parsing failed, retrying request in %g seconds. Username: %s', step, sleep_time, account['username'])
+                        update_status(status, fail=status['fail'] + 1, message=LazyMessage("Failed {} times to scan {},{} - map parsing failed - sleeping {} seconds. Username: {}", failed_total, step_location[0], step_location[1], sleep_time, account['username']))
+                        fail_rate = update_fail_rate(fail_rate, 1)
                         time.sleep(sleep_time)
 
+                if failed_total >= args.scan_retries:
+                    # Most likely it's the account that is bad rather than the
+                    # cell, so the step goes back in the queue for the other
+                    # workers, but only once. Otherwise a "bad scan" area that
+                    # fails for every account would take them out of rotation
+                    # one after another. Better to lose one cell than have the
+                    # scanner, essentially, halt. Steps of a location we have
+                    # moved away from in the meantime aren't put back either.
+                    if requeued:
+                        log.error('Search step %d went over max scan_retires again; abandoning', step)
+                    elif search_items_queue.put_back((step, step_location, step_location_i, True, generation)):
+                        log.error('Search step %d went over max scan_retires; putting it back in the queue', step)
+                    else:
+                        log.error('Search step %d went over max scan_retires; abandoning, the search location changed', step)
+                    trip_account(account, status)
+                    # Straight to the cooldown, no scan delay to wait for
+                    continue
+
                 # If there's any time left between the start time and the time when we should be kicking off the next
                 # loop, hang out until its up.
-                sleep_delay_remaining = loop_start_time + (args.scan_delay * 1000) - int(round(time.time() * 1000))
+                delay = scan_delay(args, fail_rate)
+                sleep_delay_remaining = loop_start_time + delay - monotonic()
                 if sleep_delay_remaining > 0:
-                    status['message'] = "Waiting {} seconds for scan delay".format(sleep_delay_remaining / 1000)
-                    time.sleep(sleep_delay_remaining / 1000)
+                    update_status(status, message=LazyMessage("Waiting {} seconds for scan delay", sleep_delay_remaining))
+                    time.sleep(sleep_delay_remaining)
 
-                loop_start_time += args.scan_delay * 1000
+                loop_start_time += delay
 
         # catch any process exceptions, log them, and continue the thread
+        # Network trouble, e.g. while logging in: back off, then carry on
+        except RequestException as e:
+            update_status(status, message=LazyMessage("Network error in search_worker. Username: {}", account['username']))
+            log.exception('Network error in search_worker: %s. Username: %s', e, account['username'])
+            time.sleep(sleep_time)
+
+        # Logging in failed, start over with a fresh API instance
+        except (AuthException, TooManyLoginAttempts) as e:
+            update_status(status, message=LazyMessage("Login failed in search_worker. Username: {}", account['username']))
+            log.exception('Login failed in search_worker: %s. Username: %s', e, account['username'])
+            api = None
+            time.sleep(args.login_delay)
+
+        # Anything else is most likely a one-off, don't hold up the worker
         except Exception as e:
-            status['message'] = "Exception in search_worker. Username: {}".format(account['username'])
+            errors_in_a_row += 1
+            update_status(status, message=LazyMessage("Exception in search_worker. Username: {}", account['username']))
             log.exception('Exception in search_worker: %s. Username: %s', e, account['username'])
-            time.sleep(sleep_time)
+            time.sleep(error_delay(args, errors_in_a_row))
 
 
-def search_worker_thread_ss(args, account, search_items_queue, parse_lock, encryption_lib_path, status, dbq, whq):
-    stagger_thread(args, account)
+def search_worker_thread_ss(args, account, account_index, search_items_queue, encryption_lib_path, status, dbq, whq):
+    stagger_thread(args, account_index)
     log.debug('Search worker ss thread starting')
-    status['message'] = "Search worker ss thread starting"
+    sleep_time = args.scan_delay
+    errors_in_a_row = 0
+    api = None
+    fail_rate = 0.0
     # forever loop (for catching when the other forever loop fails)
     while True:
         try:
             log.debug('Entering search loop')
-            status['message'] = "Entering search loop"
-            # create api instance
-            if args.mock != '':
-                api = FakePogoApi(args.mock)
-            else:
-                api = PGoApi()
-            if args.proxy:
-                api.set_proxy({'http': args.proxy, 'https': args.proxy})
-            api.activate_signature(encryption_lib_path)
+            # create api instance, unless we still have a good one
+            if api is None:
+                api = new_api(args, encryption_lib_path)
+                next_relogin_at = 0
             # search forever loop
             while True:
+                # sit out the cooldown if the account failed too often
+                wait_for_account(account)
                 # Grab the next thing to search (when available)
-                status['message'] = "Waiting for item from queue"
-                step, step_location, spawntime = search_items_queue.get()
-                status['message'] = "Searching at {},{}".format(step_location[0], step_location[1])
+                update_status(status, message="Waiting for item from queue")
+                step, step_location, step_location_i, spawntime = search_items_queue.get()
+                # The queue drops the spawnpoints we were 14mins too late for
+                if search_items_queue.skipped != status['skip']:
+                    log.info('Cant keep up. Skipped %d spawnpoints', search_items_queue.skipped - status['skip'])
+                update_status(status, skip=search_items_queue.skipped, message=LazyMessage("Searching at {},{}", step_location[0], step_location[1]))
                 log.info('Searching step %d, remaining %d', step, search_items_queue.qsize())
-                if timeDif(curSec(), spawntime) < 840:  # if we arnt 14mins too late
-                    # set position
-                    api.set_position(*step_location)
-                    # try scan (with retries)
-                    failed_total = 0
-                    while True:
-                        if failed_total >= args.scan_retries:
-                            log.error('Search step %d went over max scan_retires; abandoning', step)
-                            # Didn't succeed, but we are done with this queue item
-                            search_items_queue.task_done()
-
-                            # Sleep for 2 hours, print a log message every 5 minutes.
-                            long_sleep_time = 0
-                            long_sleep_started = time.strftime("%H:%M")
-                            while long_sleep_time < (2 * 60 * 20):
-                                log.error('Worker %s failed, possibly banned account. Started 2 hour sleep at %s', account['username'], long_sleep_started)
-                                status['message'] = 'Worker {} failed, possibly banned account. Started 2 hour sleep at {}'.format(account['username'], long_sleep_started)
-                                long_sleep_time += 300
-                                time.sleep(300)
-                            break
-                        sleep_time = args.scan_delay * (1 + failed_total)
-                        check_login(args, account, api, step_location)
-                        # make the map request
-                        response_dict = map_request(api, step_location, args.jitter)
-                        # check if got anything back
-                        if not response_dict:
-                            log.error('Search step %d area download failed, retyring request in %g seconds', step, sleep_time)
-                            failed_total += 1
-                            status['fail'] += 1
-                            status['message'] = "Failed {} times to scan {},{} - no response - sleeping {} seconds. Username: {}".format(failed_total, step_location[0], step_location[1], sleep_time, account['username'])
-                            time.sleep(sleep_time)
-                            continue
-                        # got responce try and parse it
-                        try:
-                            findCount = parse_map(args, response_dict, step_location, dbq, whq)
-                            log.debug('Search step %s completed', step)
-                            search_items_queue.task_done()
-                            if findCount > 0:
-                                status['success'] += 1
-                            else:
-                                status['noitems'] += 1
-                            break  # All done, get out of the request-retry loop
-                        except KeyError:
-                            log.exception('Search step %s map parsing failed, retrying request in %g seconds. Username: %s', step, sleep_time, account['username'])
-                            failed_total += 1
-                            status['fail'] += 1
-                            status['message'] = "Failed {} times to scan {},{} - map parsing failed - sleeping {} seconds. Username: {}".format(failed_total, step_location[0], step_location[1], sleep_time, account['username'])
-                            time.sleep(sleep_time)
+                # set position
+                api.set_position(*step_location)
+                # try scan (with retries)
+                failed_total = 0
+                while True:
+                    if failed_total >= args.scan_retries:
+                        break
+                    if time.time() >= next_relogin_at:
+                        next_relogin_at = check_login(args, account, api)
+                    # make the map request
+                    response_dict = map_request(api, step_location, args.jitter, step_location_i)
+                    # check if got anything back
+                    if not response_dict:
+                        failed_total += 1
+                        sleep_time = retry_delay(args, failed_total)
+                        log.error('Search step %d area download failed, retyring request in %g seconds', step, sleep_time)
+                        update_status(status, fail=status['fail'] + 1, message=LazyMessage("Failed {} times to scan {},{} - no response - sleeping {} seconds. Username: {}", failed_total, step_location[0], step_location[1], sleep_time, account['username']))
+                        fail_rate = update_fail_rate(fail_rate, 1)
+                        time.sleep(sleep_time)
+                        continue
+                    # got responce try and parse it
+                    try:
+                        findCount = parse_map(args, response_dict, step_location, dbq, whq)
+                        log.debug('Search step %s completed', step)
+                        if findCount > 0:
+                            update_status(status, success=status['success'] + 1)
+                        else:
+                            update_status(status, noitems=status['noitems'] + 1)
+                        fail_rate = update_fail_rate(fail_rate, 0)
+                        errors_in_a_row = 0
+                        break  # All done, get out of the request-retry loop
+                    except KeyError:
+                        failed_total += 1
+                        sleep_time = retry_delay(args, failed_total)
+                        log.exception('Search step %s map parsing failed, retrying request in %g seconds. Username: %s', step, sleep_time, account['username'])
+                        update_status(status, fail=status['fail'] + 1, message=LazyMessage("Failed {} times to scan {},{} - map parsing failed - sleeping {} seconds. Username: {}", failed_total, step_location[0], step_location[1], sleep_time, account['username']))
+                        fail_rate = update_fail_rate(fail_rate, 1)
                         time.sleep(sleep_time)
-                    status['message'] = "Waiting {} seconds for scan delay".format(sleep_time)
-                    time.sleep(sleep_time)
-                else:
-                    search_items_queue.task_done()
-                    log.info('Cant keep up. Skipping')
-                    status['skip'] += 1
-                    status['message'] = "Skipping spawnpoint - can't keep up."
+                if failed_total >= args.scan_retries:
+                    log.error('Search step %d went over max scan_retires; abandoning', step)
+                    # Nobody else scans this worker's spawnpoints, so it isn't
+                    # put back. Go straight to the cooldown, no scan delay.
+                    trip_account(account, status)
+                    continue
+                delay = scan_delay(args, fail_rate)
+                update_status(status, message=LazyMessage("Waiting {} seconds for scan delay", delay))
+                time.sleep(delay)
+        except RequestException as e:
+            update_status(status, message=LazyMessage("Network error in search_worker.  Username: {}", account['username']))
+            log.exception('Network error in search_worker: %s', e)
+            time.sleep(sleep_time)
+        except (AuthException, TooManyLoginAttempts) as e:
+            update_status(status, message=LazyMessage("Login failed in search_worker.  Username: {}", account['username']))
+            log.exception('Login failed in search_worker: %s', e)
+            api = None
+            time.sleep(args.login_delay)
         except Exception as e:
-            status['message'] = "Exception in search_worker.  Username: {}".format(account['username'])
+            errors_in_a_row += 1
+            update_status(status, message=LazyMessage("Exception in search_worker.  Username: {}", account['username']))
             log.exception('Exception in search_worker: %s', e)
-            time.sleep(sleep_time)
+            time.sleep(error_delay(args, errors_in_a_row))
+
+
+# Time at which the credentials of api are due to be refreshed, a minute
+# before they expire (0 if there are none yet)
+def relogin_time(api):
+    if api._auth_provider and api._auth_provider._ticket_expire:
+        return api._auth_provider._ticket_expire / 1000 - 60
+    return 0
 
 
-def check_login(args, account, api, position):
+# Logs in when needed and returns the time of the next required check
+def check_login(args, account, api):
 
     # Logged in? Enough time left? Cool!
-    if api._auth_provider and api._auth_provider._ticket_expire:
-        remaining_time = api._auth_provider._ticket_expire / 1000 - time.time()
-        if remaining_time > 60:
-            log.debug('Credentials remain valid for another %f seconds', remaining_time)
-            return
+    expire_at = relogin_time(api)
+    if expire_at > time.time():
+        log.debug('Credentials remain valid for another %f seconds', expire_at + 60 - time.time())
+        return expire_at
 
     # Try to login (a few times, but don't get stuck here)
     i = 0
-    api.set_position(position[0], position[1], position[2])
     while i < args.login_retries:
         try:
             if args.proxy:
@@ -798,23 +1197,48 @@ def check_login(args, account, api, position):
                 time.sleep(args.login_delay)
 
     log.debug('Login for account %s successful', account['username'])
+    return relogin_time(api)
+
+
+# The latitude and longitude of a location as the integers the api sends. Done
+# once per queued location, rather than on every scan of it.
+def f2i_location(location):
+    return (f2i(location[0]), f2i(location[1]))
 
 
-def map_request(api, position, jitter=False):
+# Caches the S2 cell ids around a (rounded) location. The cache is simply
+# emptied once it holds CELL_ID_CACHE_SIZE locations.
+def get_cell_ids(lat, lng):
+    key = (round(lat, 5), round(lng, 5))
+    cell_ids = cell_id_cache.get(key)
+    if cell_ids is None:
+        if len(cell_id_cache) >= CELL_ID_CACHE_SIZE:
+            cell_id_cache.clear()
+        cell_ids = cell_id_cache[key] = util.get_cell_ids(key[0], key[1])
+    return cell_ids
+
+
+# position_i is position as f2i integers (see f2i_location), when known
+def map_request(api, position, jitter=False, position_i=None):
     # create scan_location to send to the api based off of position, because tuples aren't mutable
     if jitter:
         # jitter it, just a little bit.
         scan_location = jitterLocation(position)
         log.debug("Jittered to: %f/%f/%f", scan_location[0], scan_location[1], scan_location[2])
+        scan_location_i = f2i_location(scan_location)
     else:
         # Just use the original coordinates
-        scan_location = position
+        scan_location_i = position_i or f2i_location(position)
 
     try:
-        cell_ids = util.get_cell_ids(scan_location[0], scan_location[1])
-        timestamps = [0, ] * len(cell_ids)
-        return api.get_map_objects(latitude=f2i(scan_location[0]),
-                                   longitude=f2i(scan_location[1]),
+        # The cells around the unjittered position cover the jittered one
+        # just as well, and are the same every time the step is scanned
+        cell_ids = get_cell_ids(position[0], position[1])
+        timestamps = zero_timestamps.get(len(cell_ids))
+        if timestamps is None:
+            timestamps = zero_timestamps[len(cell_ids)] = [0, ] * len(cell_ids)
+        return api.get_map_objects(latitude=scan_location_i[0],
+                                   longitude=scan_location_i[1],
                                    since_timestamp_ms=timestamps,
                                    cell_id=cell_ids)
     except Exception as e:
@@ -822,16 +1246,37 @@ def map_request(api, position, jitter=False):
         return False
 
 
-def stagger_thread(args, account):
+def stagger_thread(args, account_index):
     # If we have more than one account, stagger the logins such that they occur evenly over scan_delay
     if len(args.accounts) > 1:
         if len(args.accounts) > args.scan_delay:  # force ~1 second delay between threads if you have many accounts
-            delay = args.accounts.index(account) + ((random.random() - .5) / 2) if args.accounts.index(account) > 0 else 0
+            delay = account_index + random.uniform(-0.25, 0.25) if account_index > 0 else 0
         else:
-            delay = (args.scan_delay / len(args.accounts)) * args.accounts.index(account)
+            delay = (args.scan_delay / len(args.accounts)) * account_index
         log.debug('Delaying thread startup for %.2f seconds', delay)
         time.sleep(delay)
 
 
+# Applies changes to a worker's status in a single update, and bumps its 'seq'
+# so the status printer knows to rebuild the line
+def update_status(status, **changes):
+    changes['seq'] = status['seq'] + 1
+    status.update(changes)
+
+
+class LazyMessage(object):
+    '''
+    Worker status message that is only formatted once something shows it,
+    so the workers don't pay for it when the status screen is off.
+    '''
+
+    def __init__(self, fmt, *args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args)
+
+
 class TooManyLoginAttempts(Exception):
     pass
@@ -64,6 +64,12 @@ def get_args():
     parser.add_argument('-sd', '--scan-delay',
                         help='Time delay between requests in scan threads',
                         type=float, default=10)
+    parser.add_argument('-sdm', '--scan-delay-max',
+                        help='Max time to sleep before retrying a failed scan (at least twice the scan delay)',
+                        type=float, default=30)
+    parser.add_argument('-ad', '--adaptive-delay',
+                        help='Stretch the scan delay while scans are failing',
+                        action='store_true', default=False)
     parser.add_argument('-ld', '--login-delay',
                         help='Time delay between each login attempt',
                         type=float, default=5)